@@ -1,27 +1,127 @@
 """
 Database wrapper
 """
+import psycopg2.extensions
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
+import collections
+import threading
 import psycopg2
-
+import hashlib
+import logging
+import weakref
+import re
+import io
+
+from contextlib import contextmanager
+from uuid import uuid4
 from psycopg2 import sql
 from psycopg2.extras import execute_values
 
+# bulk inserts of more rows than this are loaded with COPY instead of
+# INSERT ... VALUES
+COPY_THRESHOLD = 1000
+
+# amount of rows per INSERT ... VALUES statement for bulk inserts
+PAGE_SIZE = 1000
+
+# types of value that can be written as is in PostgreSQL's text COPY format
+COPY_TYPES = {str, int, float}
+
+# characters that need escaping in PostgreSQL's text COPY format
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+# a plain single-table INSERT, as can be passed to Database.execute_many()
+SIMPLE_INSERT = re.compile(r"^\s*INSERT\s+INTO\s+(\w+)\s*\(([\w\s,]+)\)\s*VALUES\s+%s\s*;?\s*$", re.IGNORECASE)
+
+# the placeholder execute_values() expands into the rows
+VALUES_PLACEHOLDER = re.compile(r"\bVALUES\s+%s", re.IGNORECASE)
+
+# queries that can be run as a prepared statement, and their placeholders
+PREPARABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b", re.IGNORECASE)
+PLACEHOLDER = re.compile(r"%(%|s)")
+
+# maximum amount of prepared statements to keep per connection
+STATEMENT_CACHE_SIZE = 500
+
+# connection pools, per DSN, shared by all handlers connecting to the same
+# database
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+class StatementCachingConnection(psycopg2.extensions.connection):
+	"""
+	Connection that keeps track of the statements prepared on it
+
+	Prepared statements only exist within the session they were prepared in,
+	so the cache lives on the connection. It maps query strings to the name
+	of the prepared statement, or `None` if the query cannot be prepared.
+	`stale` holds the names of statements that still exist but can no longer
+	be used, and should be deallocated before being prepared again.
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.statements = collections.OrderedDict()
+		self.stale = set()
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+	"""
+	Thread-safe connection pool that waits for a free connection
+
+	psycopg2's own pool raises a PoolError when all connections are in use;
+	this one blocks until another thread returns a connection instead, so
+	having more worker threads than connections is not an error.
+
+	`handlers` counts the database handlers using the pool, so that it is
+	only closed once none of them need it anymore.
+	"""
+	handlers = 0
+
+	def __init__(self, minconn, maxconn, *args, **kwargs):
+		self._slots = threading.BoundedSemaphore(maxconn)
+		super().__init__(minconn, maxconn, *args, **kwargs)
+
+	def getconn(self, key=None):
+		self._slots.acquire()
+		try:
+			return super().getconn(key)
+		except Exception:
+			self._slots.release()
+			raise
+
+	def putconn(self, conn=None, key=None, close=False):
+		try:
+			super().putconn(conn, key, close)
+		finally:
+			self._slots.release()
+
 
 class Database:
 	"""
 	Simple database handler
 
 	Offers a number of abstraction methods that limit how much SQL one is
-	required to write. Also makes the database connection mostly multithreading
-	proof by instantiating a new cursor for each query (and closing it afterwards)
+	required to write. Connections are taken from a thread-safe pool, so each
+	thread runs its queries on its own connection (and returns it to the pool
+	afterwards) rather than all threads sharing a single one. Handlers for the
+	same database share a pool, so creating another one is cheap.
 	"""
-	_cursor = None
+	_pool = None
+	_closed = False
+	_dsn = None
+	_local = None
 	_log = None
+	_prepare = True
+	_compiled = None
+	_rendered = None
+	_identifiers = None
 
-	def __init__(self, logger, dbname, user, password, host, port, appname=""):
+	def __init__(self, logger, dbname, user, password, host, port, appname="", minconn=2, maxconn=10, prepare=True):
 		"""
-		Set up database connection
+		Set up database connection pool
 
 		:param logger:  Logger instance
 		:param dbname:  Database name
@@ -30,65 +130,170 @@ class Database:
 		:param host:  Database server address
 		:param port:  Database port
 		:param appname:  App name, mostly useful to trace connections in pg_stat_activity
+		:param int minconn:  Amount of connections to open right away
+		:param int maxconn:  Maximum amount of simultaneous connections. If
+		another handler already created a pool for the same database, that
+		pool and its limits are used instead.
+		:param bool prepare:  Run the queries of `update()`, `delete()` and
+		`insert()`, and those that callers mark with `prepare`, as
+		server-side prepared statements. This should be disabled when
+		connecting via a transaction-pooling proxy such as PgBouncer, since
+		prepared statements are tied to a server session.
 		"""
 
+		# checked first, so that no pool is opened or counted for a handler
+		# that cannot be used
+		if logger is None:
+			raise NotImplementedError()
+
 		appname = "dmi-db" if not appname else "dmi-db-%s" % appname
 
-		self.connection = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=port,
-										   application_name=appname)
-		self._cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+		self._dsn = psycopg2.extensions.make_dsn(dbname=dbname, user=user, password=password, host=host, port=port,
+												 application_name=appname)
+		with POOLS_LOCK:
+			self._pool = POOLS.get(self._dsn)
+			if self._pool is None or self._pool.closed:
+				self._pool = POOLS[self._dsn] = BlockingConnectionPool(
+					minconn, maxconn, self._dsn, connection_factory=StatementCachingConnection)
+			self._pool.handlers += 1
+		self._local = threading.local()
+		self._prepare = prepare
+		self._compiled = {}
+		self._rendered = {}
+		self._identifiers = {}
 		self._log = logger
 
-		if self._log is None:
-			raise NotImplementedError()
-
-		self.commit()
-
 	def query(self, query, replacements=None, cursor=None):
 		"""
 		Execute a query
 
+		If no cursor is given, the query is run without committing; it can
+		be committed later with `commit()`.
+
 		:param string query: Query
 		:param args: Replacement values
-		:param cursor: Cursor to use. Default - use common cursor
+		:param cursor: Cursor to use. Default - use a new cursor
 		:return None:
 		"""
 		if not cursor:
-			cursor = self.get_cursor()
-
-		self._log.debug("Executing query %s" % self._cursor.mogrify(query, replacements))
+			with self.cursor(commit=False, pipeline=True) as cursor:
+				return self.query(query, replacements, cursor=cursor)
 
-		return cursor.execute(query, replacements)
+		self._log_query(cursor, query, replacements)
+		return self._execute(cursor, query, replacements)
 
-	def execute(self, query, replacements=None):
+	def execute(self, query, replacements=None, commit=True):
 		"""
 		Execute a query, and commit afterwards
 
 		This is required for UPDATE/INSERT/DELETE/etc to stick
 		:param string query:  Query
 		:param replacements: Replacement values
+		:param bool commit:  Whether to commit after executing the query
 		"""
-		cursor = self.get_cursor()
-
-		self._log.debug("Executing query %s" % self._cursor.mogrify(query, replacements))
-		cursor.execute(query, replacements)
-		self.commit()
-
-		cursor.close()
+		with self.cursor(commit=commit, pipeline=True) as cursor:
+			self.query(query, replacements, cursor=cursor)
 
-	def execute_many(self, query, replacements=None):
+	def execute_many(self, query, replacements=None, page_size=PAGE_SIZE, template=None):
 		"""
 		Execute a query multiple times, each time with different values
 
 		This makes it particularly suitable for INSERT queries, but other types
 		of query using VALUES are possible too.
 
+		Large batches for plain "INSERT INTO table (columns) VALUES %s" queries
+		without a `template` are loaded with `copy_insert()` instead, which is
+		a lot faster.
+
 		:param string query:  Query
-		:param replacements: A list of replacement values
+		:param replacements: A list of replacement values, either tuples or
+		dictionaries
+		:param int page_size:  Amount of rows to send to the server per
+		statement
+		:param str template:  Template for each row of values, e.g.
+		"(%s, %s)". If omitted and the replacements are dictionaries, one is
+		derived from the keys of the first row.
+		:raises ValueError:  If the query does not contain exactly one
+		"VALUES %s", where the rows are to be inserted
+		"""
+		if isinstance(query, str) and len(VALUES_PLACEHOLDER.findall(query)) != 1:
+			raise ValueError("Query for execute_many() should contain exactly one 'VALUES %s'")
+
+		# a template given by the caller may add expressions or constants to
+		# the values, which COPY cannot do, so only plain values are copied
+		copyable = template is None
+		if replacements and template is None and isinstance(replacements[0], dict):
+			template = "(" + ", ".join(["%%(%s)s" % key for key in replacements[0]]) + ")"
+
+		insert = SIMPLE_INSERT.match(query) if isinstance(query, str) and copyable else None
+		if insert and len(replacements) > COPY_THRESHOLD:
+			# unquoted identifiers are case-insensitive, quoted ones are not
+			columns = [column.strip().lower() for column in insert.group(2).split(",")]
+			rows = replacements
+			if isinstance(replacements[0], dict):
+				keys = list(replacements[0].keys())
+				rows = [[row[key] for key in keys] for row in replacements]
+
+			try:
+				self.copy_insert(insert.group(1).lower(), columns, rows, commit=False)
+				return
+			except TypeError:
+				# values that COPY cannot encode - insert them as usual
+				pass
+
+		with self.cursor(commit=False) as cursor:
+			execute_values(cursor, query, replacements, template=template, page_size=page_size)
+
+	def copy_insert(self, table, columns, rows, commit=True, safe=False, constraints=None):
 		"""
-		cursor = self.get_cursor()
-		execute_values(cursor, query, replacements)
-		cursor.close()
+		Insert many rows at once with COPY
+
+		The rows are streamed to the server in PostgreSQL's text COPY format,
+		which is much faster than INSERT for large amounts of rows.
+
+		:param string table:  Table to insert rows into
+		:param list columns:  Columns to insert values for
+		:param rows:  List of rows, each a tuple with a value for each column
+		:param bool commit:  Whether to commit after executing the query
+		:param bool safe:  If set to `True`, rows that would violate a unique
+		index or other constraint are skipped. COPY cannot do this itself, so
+		the rows are then copied into a temporary table first and inserted
+		from there.
+		:param tuple constraints:  If `safe` is `True`, the columns that should
+		be used as a constraint, as with `insert()`
+		:return int: Number of inserted rows
+		:raises TypeError:  If a value cannot be encoded for COPY (see
+		`_copy_value()`). Nothing is sent to the database in that case.
+		"""
+		buffer = io.StringIO()
+		for row in rows:
+			buffer.write("\t".join([self._copy_value(value) for value in row]) + "\n")
+		buffer.seek(0)
+
+		columns_sql = sql.SQL(", ").join([self._identifier(column) for column in columns])
+		target = self._identifier(table)
+		if safe:
+			target = self._identifier("%s_staging" % table)
+
+		with self.cursor(commit=commit) as cursor:
+			self._log.debug("Copying %i rows into %s", len(rows), table)
+			if safe:
+				# only the copied columns, without the table's constraints,
+				# since columns that are left out would be NULL here
+				cursor.execute(sql.SQL("CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA").format(
+					target, columns_sql, self._identifier(table)))
+
+			cursor.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN").format(target, columns_sql), buffer)
+			if not safe:
+				return cursor.rowcount
+
+			cursor.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+				self._identifier(table), columns_sql, columns_sql, target) + self._on_conflict(constraints))
+			inserted = cursor.rowcount
+
+			# dropped explicitly too, since the transaction may go on
+			cursor.execute(sql.SQL("DROP TABLE {}").format(target))
+			return inserted
 
 	def update(self, table, data, where=None, commit=True):
 		"""
@@ -104,30 +309,23 @@ class Database:
 		if where is None:
 			where = {}
 
-		# build query
-		identifiers = [sql.Identifier(column) for column in data.keys()]
-		identifiers.insert(0, sql.Identifier(table))
-		replacements = list(data.values())
+		# queries are cached per combination of table and columns
+		key = ("update", table, tuple(data), tuple(where))
+		query = self._compiled.get(key)
+		if query is None:
+			query = sql.SQL("UPDATE {} SET {}").format(self._identifier(table), self._assignments(data, ", "))
+			if where:
+				query += sql.SQL(" WHERE ") + self._assignments(where, " AND ")
 
-		query = "UPDATE {} SET " + ", ".join(["{} = %s" for column in data])
-		if where:
-			query += " WHERE " + " AND ".join(["{} = %s" for column in where])
-			for column in where.keys():
-				identifiers.append(sql.Identifier(column))
-				replacements.append(where[column])
+			self._compiled[key] = query
 
-		query = sql.SQL(query).format(*identifiers)
+		replacements = list(data.values()) + list(where.values())
 
-		cursor = self.get_cursor()
-		self._log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
-		cursor.execute(query, replacements)
-
-		if commit:
-			self.commit()
-
-		result = cursor.rowcount
-		cursor.close()
-		return result
+		with self.cursor(commit=commit, pipeline=True) as cursor:
+			query = self._render(key, query, cursor)
+			self._log_query(cursor, query, replacements)
+			self._execute(cursor, query, replacements, prepare=True)
+			return cursor.rowcount
 
 	def delete(self, table, where, commit=True):
 		"""
@@ -139,31 +337,31 @@ class Database:
 
 		:return int: Number of affected rows. Note that this may be unreliable if `commit` is `False`
 		"""
-		where_sql = ["{} = %s" for column in where.keys()]
-		replacements = list(where.values())
-
-		# build query
-		identifiers = [sql.Identifier(column) for column in where.keys()]
-		identifiers.insert(0, sql.Identifier(table))
-		query = sql.SQL("DELETE FROM {} WHERE " + " AND ".join(where_sql)).format(*identifiers)
+		# queries are cached per combination of table and columns
+		key = ("delete", table, tuple(where))
+		query = self._compiled.get(key)
+		if query is None:
+			query = sql.SQL("DELETE FROM {} WHERE {}").format(self._identifier(table), self._assignments(where, " AND "))
+			self._compiled[key] = query
 
-		cursor = self.get_cursor()
-		self._log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
-		cursor.execute(query, replacements)
-
-		if commit:
-			self.commit()
+		replacements = list(where.values())
 
-		result = cursor.rowcount
-		cursor.close()
-		return result
+		with self.cursor(commit=commit, pipeline=True) as cursor:
+			query = self._render(key, query, cursor)
+			self._log_query(cursor, query, replacements)
+			self._execute(cursor, query, replacements, prepare=True)
+			return cursor.rowcount
 
 	def insert(self, table, data, commit=True, safe=False, constraints=None):
 		"""
 		Create database record
 
+		A list of records may be given instead of a single one, in which case
+		they are inserted with multi-row INSERT statements, or with COPY for
+		large amounts of records. All records should then have the same keys.
+
 		:param string table:  Table to insert record into
-		:param dict data:   Data to insert
+		:param dict data:   Data to insert, or a list of dictionaries
 		:param bool commit: Whether to commit after executing the query
 		:param bool safe: If set to `True`, "ON CONFLICT DO NOTHING" is added to the insert query, so that no error is
 						  thrown when the insert violates a unique index or other constraint
@@ -174,107 +372,638 @@ class Database:
 		if constraints is None:
 			constraints = []
 
-		# escape identifiers
-		identifiers = [sql.Identifier(column) for column in data.keys()]
-		identifiers.insert(0, sql.Identifier(table))
-
-		# construct ON NOTHING bit of query
-		if safe:
-			safe_bit = " ON CONFLICT "
-			if constraints:
-				safe_bit += "(" + ", ".join(["{}" for each in constraints]) + ")"
-				for column in constraints:
-					identifiers.append(sql.Identifier(column))
-			safe_bit += " DO NOTHING"
-		else:
-			safe_bit = ""
+		rows = data if isinstance(data, list) else [data]
+		if not rows:
+			return 0
+
+		# queries are cached per combination of table and columns. a single
+		# record gets a placeholder per value, so the query can be prepared;
+		# lists get a single placeholder that execute_values() expands
+		columns = tuple(rows[0])
+		many = isinstance(data, list)
+		key = ("insert", table, columns, safe, tuple(constraints), many)
+		query = self._compiled.get(key)
+		if query is None:
+			columns_sql = sql.SQL(", ").join([self._identifier(column) for column in columns])
+			values_sql = sql.SQL("%s") if many else sql.SQL("({})").format(
+				sql.SQL(", ").join([sql.Placeholder()] * len(columns)))
+			query = sql.SQL("INSERT INTO {} ({}) VALUES {}").format(self._identifier(table), columns_sql, values_sql)
+
+			# construct ON NOTHING bit of query
+			if safe:
+				query += self._on_conflict(constraints)
+
+			self._compiled[key] = query
+
+		if many:
+			# values are ordered by the first record's keys, whatever the
+			# order of the others
+			replacements = [tuple([row[column] for column in columns]) for row in rows]
+			if len(replacements) > COPY_THRESHOLD:
+				try:
+					return self.copy_insert(table, columns, replacements, commit=commit, safe=safe,
+											constraints=constraints)
+				except TypeError:
+					# values that COPY cannot encode - insert them as usual
+					pass
+
+			inserted = 0
+			with self.cursor(commit=commit) as cursor:
+				query = self._render(key, query, cursor)
+				self._log.debug("Inserting %i rows into %s", len(replacements), table)
+				for offset in range(0, len(replacements), PAGE_SIZE):
+					execute_values(cursor, query, replacements[offset:offset + PAGE_SIZE], page_size=PAGE_SIZE)
+					inserted += cursor.rowcount
+
+			return inserted
 
 		# prepare parameter replacements
-		protoquery = "INSERT INTO {} (%s) VALUES %%s" % ", ".join(["{}" for column in data.keys()]) + safe_bit
-		query = sql.SQL(protoquery).format(*identifiers)
-		replacements = (tuple(data.values()),)
-
-		cursor = self.get_cursor()
-		self._log.debug("Executing query: %s" % cursor.mogrify(query, replacements))
-		cursor.execute(query, replacements)
-
-		if commit:
-			self.commit()
+		replacements = list(data.values())
 
-		result = cursor.rowcount
-		cursor.close()
-		return result
+		with self.cursor(commit=commit, pipeline=True) as cursor:
+			query = self._render(key, query, cursor)
+			self._log_query(cursor, query, replacements)
+			self._execute(cursor, query, replacements, prepare=True)
+			return cursor.rowcount
 
-	def fetchall(self, query, *args):
+	def fetchall(self, query, *args, cursor_factory=None, prepare=False):
 		"""
 		Fetch all rows for a query
 
 		:param string query:  Query
 		:param args: Replacement values
+		:param cursor_factory:  Cursor class to fetch the rows with; see
+		`cursor()`
+		:param bool prepare:  Run the query as a prepared statement; see
+		`_execute()`
 		:return list: The result rows, as a list
 		"""
-		cursor = self.get_cursor()
-		self._log.debug("Executing query: %s" % cursor.mogrify(query, *args))
-		self.query(query, cursor=cursor, *args)
-
-		try:
-			result = cursor.fetchall()
-		except AttributeError:
-			result = []
+		with self.cursor(commit=not self._in_transaction(), cursor_factory=cursor_factory) as cursor:
+			replacements = args[0] if args else None
+			self._log_query(cursor, query, replacements)
+			self._execute(cursor, query, replacements, prepare=prepare)
 
-		cursor.close()
-		return result
+			try:
+				return cursor.fetchall()
+			except AttributeError:
+				return []
 
-	def fetchone(self, query, *args):
+	def fetchone(self, query, *args, cursor_factory=None, prepare=False):
 		"""
 		Fetch one result row
 
 		:param string query: Query
 		:param args: Replacement values
+		:param cursor_factory:  Cursor class to fetch the row with; see
+		`cursor()`
+		:param bool prepare:  Run the query as a prepared statement; see
+		`_execute()`
 		:return: The row, as a dictionary, or None if there were no rows
 		"""
-		cursor = self.get_cursor()
-		self.query(query, cursor=cursor, *args)
+		with self.cursor(commit=not self._in_transaction(), cursor_factory=cursor_factory) as cursor:
+			replacements = args[0] if args else None
+			self._log_query(cursor, query, replacements)
+			self._execute(cursor, query, replacements, prepare=prepare)
+
+			try:
+				return cursor.fetchone()
+			except psycopg2.ProgrammingError as e:
+				# no results to fetch - committing, if needed, happens when the
+				# cursor block ends
+				return None
+
+	def iterall(self, query, replacements=None, itersize=2000, cursor_factory=None):
+		"""
+		Iterate over all rows for a query
 
-		try:
-			result = cursor.fetchone()
-		except psycopg2.ProgrammingError as e:
-			# no results to fetch
-			self.commit()
-			result = None
+		Unlike `fetchall()`, this uses a server-side cursor, so rows are
+		fetched from the server in batches while iterating rather than all
+		at once, which keeps memory use down for large result sets. The
+		connection is in use until iteration has finished.
 
-		cursor.close()
-		return result
+		:param string query:  Query
+		:param replacements:  Replacement values
+		:param int itersize:  Amount of rows to fetch from the server at once
+		:param cursor_factory:  Cursor class to fetch the rows with; see
+		`cursor()`
+		:return:  Generator yielding the result rows, as dictionaries
+		"""
+		if cursor_factory is None:
+			cursor_factory = psycopg2.extras.RealDictCursor
+
+		if getattr(self._local, "pipeline", None):
+			# run deferred queries first, so the results include their changes
+			with self.cursor(commit=False):
+				pass
+
+		with self.connection(commit=not self._in_transaction()) as connection:
+			with connection.cursor(name="dmi_ss_%s" % uuid4().hex, cursor_factory=cursor_factory) as cursor:
+				cursor.itersize = itersize
+				self._log_query(cursor, query, replacements)
+				cursor.execute(query, replacements)
+				yield from cursor
 
 	def commit(self):
 		"""
 		Commit the current transaction
 
-		This is required for UPDATE etc to stick.
+		This is required for UPDATE etc to stick. Only queries run from the
+		calling thread are committed. Within a `transaction()` block, this
+		does nothing; the transaction is committed when the block ends.
 		"""
-		self.connection.commit()
+		if getattr(self._local, "depth", 0):
+			return
+
+		connection = getattr(self._local, "connection", None)
+		if connection is not None:
+			connection.commit()
+			self._release(connection)
 
 	def rollback(self):
 		"""
 		Roll back the current transaction
+
+		Only queries run from the calling thread are rolled back. Within a
+		`transaction()` block, the thread keeps its connection, so that the
+		rest of the block still runs on the same one.
 		"""
-		self.connection.rollback()
+		connection = getattr(self._local, "connection", None)
+		if connection is not None:
+			connection.rollback()
+			if not getattr(self._local, "depth", 0):
+				self._release(connection)
 
 	def close(self):
 		"""
-		Close connection
+		Close the handler
 
+		Uncommitted queries from the calling thread are rolled back. The pool
+		is shared with other handlers for the same database, so its
+		connections are only closed once the last of those is closed too.
 		Running queries after this is probably a bad idea!
 		"""
-		self.connection.close()
+		if self._closed:
+			return
+
+		self._closed = True
+		connection = getattr(self._local, "connection", None)
+		if connection is not None:
+			connection.rollback()
+			self._release(connection)
+
+		with POOLS_LOCK:
+			self._pool.handlers -= 1
+			if self._pool.handlers <= 0:
+				self._pool.closeall()
+				if POOLS.get(self._dsn) is self._pool:
+					del POOLS[self._dsn]
+
+	def listen(self, channel):
+		"""
+		Get a connection that listens for notifications on a channel
+
+		The connection has to stay open for as long as notifications are
+		wanted, so it is not taken from the pool. It can be passed to
+		`select.select()` to wait for notifications, which can then be read
+		via its `poll()` method and `notifies` attribute.
+
+		:param str channel:  Channel to listen on
+		:return:  Connection
+		"""
+		connection = psycopg2.connect(self._dsn)
+		connection.autocommit = True
+		with connection.cursor() as cursor:
+			cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+
+		return connection
+
+	@contextmanager
+	def transaction(self):
+		"""
+		Run a number of queries as a single transaction
+
+		Queries run from the calling thread within the block are not committed
+		individually, whatever their `commit` argument; instead they are
+		committed together when the block ends, or rolled back if it raises an
+		exception. Blocks may be nested, in which case the outermost one
+		commits.
+
+		The database handler itself is returned, so queries can be written
+		as `with db.transaction() as tx: tx.update(...); tx.delete(...)`.
+		Use this rather than passing `commit=False` to each query and calling
+		`commit()` afterwards; if something goes wrong halfway, the queries
+		are rolled back rather than left waiting for a commit.
+		"""
+		depth = getattr(self._local, "depth", 0)
+		self._local.depth = depth + 1
+		try:
+			yield self
+		except BaseException:
+			# this includes GeneratorExit and KeyboardInterrupt, which would
+			# otherwise leave the depth (and the connection) stuck
+			self._local.depth = depth
+			if not depth:
+				self.rollback()
+			raise
+
+		self._local.depth = depth
+		if not depth:
+			self.commit()
+
+	@contextmanager
+	def connection(self, commit=True):
+		"""
+		Get a connection from the pool
+
+		The connection is returned to the pool afterwards. If `commit` is
+		`False`, or within a `transaction()` block, the transaction is left
+		open and the calling thread keeps the connection until `commit()` or
+		`rollback()` is called, so that its later queries become part of the
+		same transaction. If an error occurs the transaction is rolled back
+		(at the end of the `transaction()` block, if there is one).
+
+		:param bool commit:  Whether to commit after the block has finished
+		"""
+		connection = getattr(self._local, "connection", None)
+		if connection is None:
+			connection = self._getconn()
+
+		in_transaction = getattr(self._local, "depth", 0) > 0
+		if not commit or in_transaction:
+			# held from the start, so that queries run by the thread while the
+			# block is still going, e.g. while iterating over `iterall()`,
+			# use the same connection
+			self._hold(connection)
+
+		try:
+			yield connection
+		except BaseException:
+			# this includes GeneratorExit, e.g. when iteration over `iterall()`
+			# is stopped before all rows have been read
+			if in_transaction:
+				self._hold(connection)
+			else:
+				connection.rollback()
+				self._release(connection)
+			raise
+
+		if commit and not in_transaction:
+			connection.commit()
+			self._release(connection)
+		else:
+			self._hold(connection)
+
+	@contextmanager
+	def pipeline(self):
+		"""
+		Send a number of queries to the server in one go
+
+		Queries run from the calling thread within the block with `query()`,
+		`execute()`, `update()`, `delete()` or `insert()` (with a single
+		record) are not sent to the server right away. Instead, they are
+		collected and sent together when the block ends, which saves a round
+		trip per query. Other methods still run their queries immediately,
+		after sending whatever was collected so far.
+
+		Since the deferred queries have not run yet when the methods return,
+		the number of affected rows they return is meaningless, and errors
+		are only raised at the end of the block. Queries that depend on
+		either should not be run in a pipeline.
 
-	def get_cursor(self):
+		The block is also a `transaction()`, and is committed at the end.
+
+		Usage: `with db.pipeline(): db.update(...); db.delete(...)`
+		"""
+		if getattr(self._local, "pipeline", None) is not None:
+			# already collecting queries
+			yield self
+			return
+
+		with self.transaction():
+			self._local.pipeline = []
+			try:
+				yield self
+				pending = self._local.pipeline
+			finally:
+				self._local.pipeline = None
+
+			if pending:
+				with self.cursor() as cursor:
+					cursor.execute(b";\n".join(pending))
+
+	@contextmanager
+	def cursor(self, commit=True, pipeline=False, cursor_factory=None):
+		"""
+		Get a new cursor on a pooled connection
+
+		:param bool commit:  Whether to commit after the block has finished;
+		see `connection()`
+		:param bool pipeline:  Whether queries run with `_execute()` in the
+		block may be deferred, if within a `pipeline()` block. If not, any
+		queries deferred so far are sent first, and queries in the block are
+		run immediately.
+		:param cursor_factory:  Cursor class to use. By default, rows are
+		returned as dictionaries, which the rest of the scheduler expects;
+		something lighter like `psycopg2.extensions.cursor` (plain tuples)
+		may be passed where only a value or two is needed from many rows.
 		"""
-		Get a new cursor
+		if cursor_factory is None:
+			cursor_factory = psycopg2.extras.RealDictCursor
+
+		with self.connection(commit=commit) as connection:
+			with connection.cursor(cursor_factory=cursor_factory) as cursor:
+				pending = getattr(self._local, "pipeline", None)
+				if pending is None or pipeline:
+					yield cursor
+					return
+
+				self._local.pipeline = None
+				try:
+					if pending:
+						cursor.execute(b";\n".join(pending))
+
+					yield cursor
+				finally:
+					self._local.pipeline = []
+
+	def _log_query(self, cursor, query, replacements=None):
+		"""
+		Log a query that is about to be run
+
+		`mogrify()` escapes every replacement value, so the query is only
+		rendered if it is actually going to be logged.
 
-		Re-using cursors seems to give issues when using per-thread
-		connections, so simply instantiate a new one each time
+		:param cursor:  Cursor the query will be run with
+		:param query:  Query
+		:param replacements:  Replacement values
+		"""
+		if self._log.isEnabledFor(logging.DEBUG):
+			self._log.debug("Executing query %s", cursor.mogrify(query, replacements))
 
-		:return: Cursor
+	def _execute(self, cursor, query, replacements=None, prepare=False):
 		"""
-		return self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+		Run a query on a cursor
+
+		With `prepare`, plain string queries are run as server-side prepared
+		statements where possible, so that the server only needs to parse and
+		plan them once per connection. Composed queries should be rendered
+		with `as_string()` first to benefit from this. Within a `pipeline()`
+		block, the query is only collected, to be sent later.
+
+		Only queries whose parameters the server can infer the types of
+		should be prepared, e.g. values compared to or stored in a column.
+		Otherwise the results may differ from running the query as is: a
+		parameter that is only selected is sent as text, so `SELECT %s` with
+		5 returns '5' instead of 5.
+
+		:param cursor:  Cursor to run the query with
+		:param query:  Query
+		:param replacements:  Replacement values
+		:param bool prepare:  Whether the query may be prepared
+		:return:  Whatever `cursor.execute()` returns
+		"""
+		pending = getattr(self._local, "pipeline", None)
+		if pending is not None:
+			# sent later, see pipeline()
+			pending.append(cursor.mogrify(query, replacements))
+			return None
+
+		statement = self._prepare_statement(cursor, query, replacements) if prepare and self._prepare else None
+		if not statement:
+			return cursor.execute(query, replacements)
+
+		try:
+			if replacements:
+				return cursor.execute("EXECUTE %s (%s)" % (statement, ", ".join(["%s"] * len(replacements))), replacements)
+			else:
+				return cursor.execute("EXECUTE %s" % statement)
+		except (psycopg2.errors.FeatureNotSupported, psycopg2.errors.InvalidSqlStatementName) as e:
+			# the statement no longer works, e.g. because a table it uses has
+			# changed ("cached plan must not change result type"), or no
+			# longer exists. the transaction has failed anyway at this point,
+			# but forget about it so it is prepared anew on the next attempt
+			cursor.connection.statements.pop(query, None)
+			if isinstance(e, psycopg2.errors.FeatureNotSupported):
+				cursor.connection.stale.add(statement)
+			raise
+
+	def _prepare_statement(self, cursor, query, replacements):
+		"""
+		Get the name of the prepared statement for a query
+
+		The statement is prepared on the cursor's connection if that has not
+		happened yet. The least recently used statement is deallocated when
+		the connection has too many.
+
+		:param cursor:  Cursor to prepare the statement with
+		:param query:  Query
+		:param replacements:  Replacement values
+		:return:  Statement name, or `None` if the query cannot be prepared
+		"""
+		if not isinstance(query, str) or isinstance(replacements, dict) or not PREPARABLE.match(query):
+			return None
+
+		# tuples (for "IN %s") and AsIs values are SQL rather than a value,
+		# which cannot be passed as a parameter
+		if replacements and any(isinstance(value, (tuple, psycopg2.extensions.AsIs)) for value in replacements):
+			return None
+
+		statements = cursor.connection.statements
+		if query in statements:
+			statements.move_to_end(query)
+			return statements[query]
+
+		# convert psycopg2's placeholders to positional parameters
+		body = query.strip().rstrip(";")
+		if replacements is not None:
+			positions = iter(range(1, len(replacements) + 1))
+			try:
+				body = PLACEHOLDER.sub(lambda match: "%" if match.group(1) == "%" else "$%i" % next(positions), body)
+			except StopIteration:
+				# more placeholders than values - let psycopg2 complain
+				return None
+
+			if next(positions, None) is not None:
+				return None
+
+		if ";" in body:
+			# multiple statements cannot be prepared as one
+			return None
+
+		name = "dmi_stmt_%s" % hashlib.md5(query.encode("utf-8")).hexdigest()[:12]
+		if len(statements) >= STATEMENT_CACHE_SIZE:
+			evicted = statements.popitem(last=False)[1]
+			if evicted:
+				cursor.execute("DEALLOCATE %s" % evicted)
+
+		if name in cursor.connection.stale:
+			cursor.connection.stale.discard(name)
+			cursor.execute("DEALLOCATE %s" % name)
+
+		# the savepoint is set separately, so that it exists even if the
+		# PREPARE cannot even be parsed
+		cursor.execute("SAVEPOINT dmi_prepare")
+		try:
+			cursor.execute("PREPARE %s AS %s" % (name, body))
+		except psycopg2.Error:
+			# e.g. if the type of a parameter cannot be determined - in that
+			# case, simply run the query as is, now and later
+			cursor.execute("ROLLBACK TO SAVEPOINT dmi_prepare")
+			name = None
+
+		cursor.execute("RELEASE SAVEPOINT dmi_prepare")
+
+		statements[query] = name
+		return name
+
+	def _render(self, key, query, cursor):
+		"""
+		Get a cached composed query as a string
+
+		Rendering a composed query needs a connection, so this is done the
+		first time the query is run rather than when it is composed. After
+		that, the string is reused.
+
+		:param tuple key:  Key the composed query is cached under
+		:param sql.Composed query:  Composed query
+		:param cursor:  Cursor to render the query with
+		:return str:  Query
+		"""
+		rendered = self._rendered.get(key)
+		if rendered is None:
+			rendered = self._rendered[key] = query.as_string(cursor)
+
+		return rendered
+
+	def _identifier(self, name):
+		"""
+		Get an escaped identifier for use in a query
+
+		Identifiers are immutable and the same few are used all the time, so
+		each is only created once.
+
+		:param str name:  Table or column name
+		:return sql.Identifier:
+		"""
+		identifier = self._identifiers.get(name)
+		if identifier is None:
+			identifier = self._identifiers[name] = sql.Identifier(name)
+
+		return identifier
+
+	def _assignments(self, columns, separator):
+		"""
+		Compose a list of "column = %s" expressions
+
+		:param columns:  Column names
+		:param str separator:  What to put between the expressions, e.g. ", "
+		or " AND "
+		:return sql.Composed:
+		"""
+		return sql.SQL(separator).join([sql.SQL("{} = %s").format(self._identifier(column)) for column in columns])
+
+	def _on_conflict(self, constraints):
+		"""
+		Compose an "ON CONFLICT DO NOTHING" clause
+
+		:param constraints:  Columns to use as a constraint, or an empty list
+		to skip rows that conflict with any constraint
+		:return sql.Composed:
+		"""
+		clause = sql.SQL(" ON CONFLICT ")
+		if constraints:
+			clause += sql.SQL("({})").format(sql.SQL(", ").join([self._identifier(column) for column in constraints]))
+
+		return clause + sql.SQL(" DO NOTHING")
+
+	@staticmethod
+	def _copy_value(value):
+		"""
+		Encode a value as a field in PostgreSQL's text COPY format
+
+		Only simple values are supported. Others, like lists or bytes, would
+		need the same adaptation psycopg2 does for queries, so those should be
+		inserted with a query instead.
+
+		:param value:  Value to encode
+		:return str:  Encoded value
+		:raises TypeError:  If the value is of a type that cannot be encoded
+		"""
+		if value is None:
+			return "\\N"
+		elif isinstance(value, bool):
+			return "t" if value else "f"
+		elif type(value) not in COPY_TYPES:
+			raise TypeError("Cannot encode value of type %s for COPY" % type(value).__name__)
+
+		return str(value).translate(COPY_ESCAPES)
+
+	def _in_transaction(self):
+		"""
+		Does the calling thread hold a connection with uncommitted queries?
+
+		:return bool:
+		"""
+		return getattr(self._local, "connection", None) is not None
+
+	def _getconn(self):
+		"""
+		Check out a connection from the pool
+
+		Connections that were lost while idle in the pool are replaced by a
+		fresh one.
+
+		:return: Connection
+		"""
+		connection = self._pool.getconn()
+		if connection.closed:
+			self._pool.putconn(connection, close=True)
+			connection = self._pool.getconn()
+
+		return connection
+
+	def _hold(self, connection):
+		"""
+		Reserve a connection for the calling thread
+
+		If the thread ends without committing or rolling back, the connection
+		is returned to the pool (and rolled back) once the thread is garbage
+		collected, so that it is not lost to the pool forever.
+
+		:param connection:  Connection to hold on to
+		"""
+		if getattr(self._local, "connection", None) is connection:
+			return
+
+		self._local.connection = connection
+		self._local.finalizer = weakref.finalize(threading.current_thread(), self._release_abandoned, connection)
+
+	def _release(self, connection):
+		"""
+		Return a connection to the pool
+
+		:param connection:  Connection to release
+		"""
+		# the thread may hold another connection, e.g. if it ran a query
+		# while iterating over `iterall()`, which should be left alone
+		if getattr(self._local, "connection", None) is connection:
+			finalizer = getattr(self._local, "finalizer", None)
+			if finalizer:
+				finalizer.detach()
+
+			self._local.connection = None
+			self._local.finalizer = None
+
+		self._pool.putconn(connection)
+
+	def _release_abandoned(self, connection):
+		"""
+		Return a connection held by a thread that no longer exists
+
+		:param connection:  Connection to release
+		"""
+		try:
+			self._pool.putconn(connection)
+		except psycopg2.pool.PoolError:
+			# pool was closed in the meantime
+			pass
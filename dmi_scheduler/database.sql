@@ -19,3 +19,42 @@ CREATE UNIQUE INDEX IF NOT EXISTS unique_job
     pythonfile,
     remote_id
   );
+
+-- finding the next job to claim; only covers unclaimed jobs, and is ordered
+-- by queue time, so the first match is the job to claim
+CREATE INDEX IF NOT EXISTS jobs_claimable_idx
+  ON jobs (
+    pythonfile,
+    timestamp
+  ) WHERE timestamp_claimed = 0;
+
+-- looking up jobs by remote ID regardless of type
+CREATE INDEX IF NOT EXISTS jobs_remote_idx
+  ON jobs (
+    remote_id
+  );
+
+-- when a job may next be claimed, as far as its interval is concerned; 0 for
+-- jobs without an interval. as a column, this can be indexed, unlike the
+-- expression it is based on. ALTER TABLE locks the table even if the column
+-- already exists, so it is only run if it does not
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM information_schema.columns
+     WHERE table_schema = current_schema()
+       AND table_name = 'jobs'
+       AND column_name = 'next_claim_at'
+  ) THEN
+    ALTER TABLE jobs ADD COLUMN next_claim_at bigint
+      GENERATED ALWAYS AS (CASE WHEN interval = 0 THEN 0 ELSE timestamp_lastclaimed::bigint + interval END) STORED;
+  END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS jobs_next_claim_idx
+  ON jobs (
+    pythonfile,
+    next_claim_at,
+    timestamp
+  ) WHERE timestamp_claimed = 0;
@@ -42,7 +42,7 @@ class Job:
 		:param database:  Database handler
 		:return Job: Job object
 		"""
-		data = database.fetchone("SELECT * FROM jobs WHERE id = %s", (id,))
+		data = database.fetchone("SELECT * FROM jobs WHERE id = %s", (id,), prepare=True)
 		if not data:
 			raise JobNotFoundException
 
@@ -58,6 +58,17 @@ class Job:
 		"""
 		return Job(data, database)
 
+	def get_by_rows(rows, database):
+		"""
+		Instantiate job objects for a number of database rows
+
+		:param rows:  Iterable of job data, each corresponding to a database
+		row. Empty rows are skipped.
+		:param database:  Database handler
+		:return: Generator yielding Job objects
+		"""
+		return (Job(data, database) for data in rows if data)
+
 	def get_by_remote_ID(remote_id, database, pythonfile="*"):
 		"""
 		Instantiate job object by combination of remote ID and job type
@@ -70,9 +81,10 @@ class Job:
 		:return Job: Job object
 		"""
 		if pythonfile != "*":
-			data = database.fetchone("SELECT * FROM jobs WHERE pythonfile = %s AND remote_id = %s", (pythonfile, remote_id))
+			data = database.fetchone("SELECT * FROM jobs WHERE pythonfile = %s AND remote_id = %s", (pythonfile, remote_id),
+									 prepare=True)
 		else:
-			data = database.fetchone("SELECT * FROM jobs WHERE remote_id = %s", (remote_id,))
+			data = database.fetchone("SELECT * FROM jobs WHERE remote_id = %s", (remote_id,), prepare=True)
 
 		if not data:
 			raise JobNotFoundException
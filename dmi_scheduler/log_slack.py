@@ -1,43 +1,49 @@
 from logging import getLogger, Handler, Formatter, Filter
+from queue import Queue
+import traceback
+import threading
 import platform
-import copy
 import sys
+import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 logger = getLogger(__name__)
 
 
 class SlackHandler(Handler):
     """
     SlackHandler instances dispatch logging events to Slack Incoming Webhook.
+    Messages are sent from a separate thread, so that logging does not need
+    to wait for Slack to respond.
     :param webhook_url: Slack Incoming Webhook URL.
     """
     def __init__(self, webhook_url):
         super().__init__()
 
         self.url = webhook_url
+        self.hostname = platform.uname().node
 
         self.setFormatter(SlackFormatter())
 
+        # keep the connection to Slack alive between messages
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        self._queue = Queue()
+        self._sender = threading.Thread(target=self._send_queued, name="slack-handler", daemon=True)
+        self._sender.start()
+
     def emit(self, record):
-        # Try to locate error
+        # Try to locate error - walk the stack outwards in a single pass,
+        # starting two frames up (i.e. skipping this method and handle())
         try:
-            frames = []
-            frame_index = 2
-            while True:
-                try:
-                    frame = sys._getframe(frame_index)
-                    frames.append(frame)
-                except ValueError:
-                    break
-                frame_index += 1
-
             location = "`%s`" % "` ← `".join(
-                        [frame.f_code.co_filename.split("/").pop() + ":" + str(frame.f_lineno) for frame in frames])
+                        ["%s:%i" % (os.path.basename(frame.f_code.co_filename), lineno) for frame, lineno in
+                         traceback.walk_stack(sys._getframe(2))])
         except AttributeError:
             # the _getframe method may not be available
             location = "Unknown"
-            frames = []
 
         # Format record
         if isinstance(self.formatter, SlackFormatter):
@@ -52,18 +58,33 @@ class SlackHandler(Handler):
                                 }]
 
         payload = {
-            "text": "4CAT Alert logged on `%s`:" % platform.uname().node,
+            "text": "4CAT Alert logged on `%s`:" % self.hostname,
             'attachments': [
                 attachment
             ]
         }
 
-        data = json.dumps(payload).encode('utf-8')
-        try:
-            e = requests.post(self.url, data)
-        except requests.RequestException as e:
-            # Log error somewhere
-            logger.error('Failed to process task: %s', str(e))
+        self._queue.put_nowait(payload)
+
+    def close(self):
+        # send whatever is still queued before shutting down
+        self._queue.put(None)
+        self._sender.join(timeout=5)
+        self._session.close()
+        super().close()
+
+    def _send_queued(self):
+        while True:
+            payload = self._queue.get()
+            if payload is None:
+                break
+
+            data = json.dumps(payload).encode('utf-8')
+            try:
+                self._session.post(self.url, data=data, timeout=5)
+            except requests.RequestException as e:
+                # Log error somewhere
+                logger.error('Failed to process task: %s', str(e))
 
 class SlackFormatter(Formatter):
     """
@@ -89,12 +110,16 @@ class SlackFormatter(Formatter):
             'text': '%(message)s\n',
         }
         self.attachment.update(attr)
+        self.text = self.attachment['text']
 
     def format(self, record):
         record.message = super(SlackFormatter, self).format(record)
-        attachment = copy.deepcopy(self.attachment)
-        attachment['text'] = attachment['text'] % record.__dict__
-        attachment.update({'color': self.level_to_color[record.levelname]})
+
+        # only top-level keys of the attachment are ever replaced, so a
+        # shallow copy of the template suffices
+        attachment = dict(self.attachment)
+        attachment['text'] = self.text % record.__dict__
+        attachment['color'] = self.level_to_color[record.levelname]
 
         return attachment
 
@@ -1,17 +1,18 @@
 """
 The heart of the app - manages jobs and workers
 """
+import importlib.util
 import threading
 import logging
 import inspect
+import select
 import yaml
 import time
 import sys
+import os
 import re
 
 from pathlib import Path
-from types import ModuleType
-from importlib.machinery import SourceFileLoader
 from logging.handlers import RotatingFileHandler
 
 from dmi_scheduler.worker import BasicWorker
@@ -19,6 +20,11 @@ from dmi_scheduler.queue import JobQueue
 from dmi_scheduler.database import Database
 from dmi_scheduler.exceptions import JobClaimedException
 
+# used to derive module names from worker file paths
+INVALID_MODULE_CHARS = re.compile(r"[^0-9a-zA-Z._]")
+REPEATED_DOTS = re.compile(r"\.+")
+LEADING_DOTS = re.compile(r"^\.+")
+
 
 class WorkerManager(threading.Thread):
 	"""
@@ -27,12 +33,26 @@ class WorkerManager(threading.Thread):
 	queue = None
 	_db = None
 	_log = None
+	_listener = None
 
 	looping = True
+	_last_reap = 0
 	_worker_map = {}
+	_worker_versions = {}
+	_worker_broken_versions = {}
 	_worker_pool = {}
+	_type_cache = {}
+	_pythonfile_types = {}
+	_jobs_announced = True
+	_last_queue_query = 0
+	_queue_queries = 0
+	_queue_queries_since = 0
 	_job_mapping = {}
 
+	# seconds to wait for new jobs between delegation rounds
+	POLL_INTERVAL_BUSY = 0.1
+	POLL_INTERVAL_IDLE = 1
+
 	def __init__(self, *args, **kwargs):
 		"""
 		Initialize manager
@@ -86,6 +106,14 @@ class WorkerManager(threading.Thread):
 
 		:param str dbport:  Port of the PostgreSQL database used to store
 		the job queue. Defaults to 5432.
+
+		:param int dbpoolsize:  Maximum amount of simultaneous connections to
+		the PostgreSQL database. Workers wait for a free connection when all
+		are in use. Defaults to 10.
+
+		:param bool dbprepare:  Whether to run repeated queries as prepared
+		statements. Disable this when connecting through a transaction-pooling
+		proxy such as PgBouncer. Defaults to True.
 		"""
 		super(WorkerManager, self).__init__()
 
@@ -142,7 +170,9 @@ class WorkerManager(threading.Thread):
 			user=config.get("dbuser", kwargs.get("dbuser")),
 			password=config.get("dbpassword", kwargs.get("dbpassword")),
 			host=config.get("dbhost", kwargs.get("dbhost", "localhost")),
-			port=config.get("dbport", kwargs.get("dbport", 5432))
+			port=config.get("dbport", kwargs.get("dbport", 5432)),
+			maxconn=int(config.get("dbpoolsize", kwargs.get("dbpoolsize", 10))),
+			prepare=config.get("dbprepare", kwargs.get("dbprepare", True))
 		)
 
 		self.database_setup()
@@ -150,6 +180,9 @@ class WorkerManager(threading.Thread):
 		# with the database and logger, we can instantiate a queue
 		self.queue = JobQueue(logger=self._log, database=self._db)
 
+		# get notified of new jobs, so the queue does not need to be polled
+		self._listener = self._db.listen(JobQueue.NOTIFY_CHANNEL)
+
 	# it's time
 
 	def database_setup(self):
@@ -165,38 +198,66 @@ class WorkerManager(threading.Thread):
 
 		Checks for open jobs, and then passes those to dedicated workers, if
 		slots are available for those workers.
-		"""
-		jobs = self.queue.get_all_jobs()
 
+		How long each round takes, and how much of that is spent waiting for
+		the database, is logged at the DEBUG level.
+		"""
+		round_start = time.perf_counter()
 		num_active = sum([len(self._worker_pool[pythonfile]) for pythonfile in self._worker_pool])
 		self._log.debug("Running workers: %i" % num_active)
 
-		# clean up workers that have finished processing
-		for pythonfile in self._worker_pool:
-			all_workers = self._worker_pool[pythonfile]
-			for worker in all_workers:
-				if not worker.is_alive():
-					self._log.debug("Waiting for worker of type %s to rejoin..." % pythonfile)
-					worker.join()
-					self._worker_pool[pythonfile].remove(worker)
-					self._log.debug("Worker joined and ended.")
+		# clean up workers that have finished processing - lots of
+		# notifications can make this run very often, so don't bother more than
+		# once per polling interval
+		if time.time() - self._last_reap >= self.POLL_INTERVAL_BUSY:
+			self._last_reap = time.time()
+			for pythonfile in list(self._worker_pool.keys()):
+				alive = []
+				for worker in self._worker_pool[pythonfile]:
+					if worker.is_alive():
+						alive.append(worker)
+					else:
+						self._log.debug("Waiting for worker of type %s to rejoin..." % pythonfile)
+						worker.join()
+						self._log.debug("Worker joined and ended.")
+
+				self._worker_pool[pythonfile] = alive
+
+		# don't fetch jobs for worker types that have no free slots anyway -
+		# and if no type has a free slot, only look at the queue if new jobs
+		# were announced, since those may be of a type not seen before, or
+		# every so often, since jobs of such a type may also become claimable
+		# without being announced (e.g. when their claim_after time passes)
+		saturated = {worker_type for worker_type, worker_class in self._worker_map.items() if
+					 len(self._worker_pool.get(worker_type, [])) >= worker_class.max_workers}
+		if saturated and len(saturated) == len(self._worker_map) and not self._jobs_announced and \
+				time.time() - self._last_queue_query < self.POLL_INTERVAL_IDLE:
+			return
 
-			del all_workers
+		self._jobs_announced = False
+		self._last_queue_query = time.time()
+		skip = [pythonfile for pythonfile, worker_type in self._pythonfile_types.items() if worker_type in saturated]
+
+		query_start = time.perf_counter()
+		jobs = self.queue.get_all_jobs(skip_pythonfiles=skip)
+		db_time = time.perf_counter() - query_start
+		self._queue_queries += 1
 
 		# check if workers are available for unclaimed jobs
+		missing = []
 		for job in jobs:
 			pythonfile = Path(job.data["pythonfile"])
 
 			# does the worker script actually exist?
 			if not pythonfile.exists():
-				job.add_status("Job script does not exist. Cancelling.")
-				job.finish()
+				missing.append(job)
 				continue
 
 			# import from arbitrary source file
 			# module name will be based on file path - e.g. home.sam.4cat.workers.some_worker
-			worker_class = self.get_worker_for_file(pythonfile)
 			worker_type = self.get_worker_type_for_file(pythonfile)
+			worker_class = self.get_worker_for_file(pythonfile, worker_type)
+			self._pythonfile_types[job.data["pythonfile"]] = worker_type
 			if not worker_class:
 				continue
 
@@ -208,14 +269,49 @@ class WorkerManager(threading.Thread):
 				continue
 
 			try:
-				job.claim()
+				query_start = time.perf_counter()
+				try:
+					job.claim()
+				finally:
+					db_time += time.perf_counter() - query_start
+
 				worker = worker_class(logger=self._log, manager=self, job=job)
 				worker.start()
 				self._worker_pool[worker_type].append(worker)
 			except JobClaimedException:
 				continue
 
-		time.sleep(0.1)
+		if missing:
+			query_start = time.perf_counter()
+			self.queue.bulk_cancel(missing, "Job script does not exist. Cancelling.")
+			db_time += time.perf_counter() - query_start
+
+		round_time = time.perf_counter() - round_start
+		self._log.debug("Delegated %i jobs in %.1f ms (database: %.1f ms, other: %.1f ms)", len(jobs),
+						round_time * 1000, db_time * 1000, (round_time - db_time) * 1000)
+
+		queries_elapsed = time.time() - self._queue_queries_since
+		if queries_elapsed >= 1:
+			self._log.debug("Queue queried %.1f times per second", self._queue_queries / queries_elapsed)
+			self._queue_queries = 0
+			self._queue_queries_since = time.time()
+
+	def wait_for_jobs(self):
+		"""
+		Wait until there may be work to delegate
+
+		Returns as soon as a new job is announced via the queue's notification
+		channel, or after a timeout, since jobs also become claimable as time
+		passes and running workers may finish and free up a slot. The timeout
+		is short while workers are running and longer when idle.
+		"""
+		busy = any(self._worker_pool.values())
+		timeout = self.POLL_INTERVAL_BUSY if busy else self.POLL_INTERVAL_IDLE
+
+		if select.select([self._listener], [], [], timeout) != ([], [], []):
+			self._listener.poll()
+			self._jobs_announced = self._jobs_announced or bool(self._listener.notifies)
+			self._listener.notifies.clear()
 
 	def get_worker_type_for_file(self, pythonfile):
 		"""
@@ -230,46 +326,82 @@ class WorkerManager(threading.Thread):
 
 		home.sam.pythonfiles.scripts.generate_something
 
+		Results are cached per path.
+
 		:param Path pythonfile:  Path to file to generate module name for
 		:return str:  Module name
 		"""
+		key = str(pythonfile)
+		if key in self._type_cache:
+			return self._type_cache[key]
+
 		# make path absolute (though it realistically should be absolute already)
 		pythonfile = pythonfile.resolve()
 
-		worker_type = re.sub(r"[^0-9a-zA-Z._]", "", ".".join(pythonfile.parts).replace("-", "_"))
-		worker_type = re.sub(r"\.+", ".", worker_type)
-		worker_type = re.sub(r"^\.+", "", worker_type).lower()
+		worker_type = INVALID_MODULE_CHARS.sub("", ".".join(pythonfile.parts).replace("-", "_"))
+		worker_type = REPEATED_DOTS.sub(".", worker_type)
+		worker_type = LEADING_DOTS.sub("", worker_type).lower()
+
+		self._type_cache[key] = worker_type
 		return worker_type
 
-	def get_worker_for_file(self, pythonfile):
+	def get_worker_for_file(self, pythonfile, worker_type=None):
 		"""
 		Return a worker class for a given Python file
 
 		If the file contains no class that descends BasicWorker and can be
 		instantiated as a worker, `None` is returned instead. Results are
-		cached.
+		cached until the file is modified, after which it is loaded anew. If
+		the modified file cannot be loaded, the class loaded before is
+		returned instead.
 
 		:param pythonfile:  Path to a python file containing a worker class
+		:param str worker_type:  Module name for the file, if already known;
+		see `get_worker_type_for_file()`
 		:return:  Class that can be instantiated as a worker
 		"""
-		worker_type = self.get_worker_type_for_file(pythonfile)
-
-		if worker_type in self._worker_map:
-			return self._worker_map[worker_type]
-
-		if worker_type not in sys.modules:
-			loader = SourceFileLoader(worker_type, str(pythonfile))
-			worker_module = ModuleType(loader.name)
-			loader.exec_module(worker_module)
-			sys.modules[worker_type] = worker_module
+		if not worker_type:
+			worker_type = self.get_worker_type_for_file(pythonfile)
 
-		for component in inspect.getmembers(sys.modules[worker_type]):
-			if component[0][0:2] != "__" \
-					and inspect.isclass(component[1]) \
-					and (issubclass(component[1], BasicWorker) or issubclass(component[1], BasicWorker)) \
-					and not inspect.isabstract(component[1]):
-				self._worker_map[worker_type] = component[1]
-				return self._worker_map[worker_type]
+		# resolved, so that the same file is not loaded again just because
+		# it is referred to by a different path
+		try:
+			pythonfile = pythonfile.resolve()
+			version = (str(pythonfile), os.stat(pythonfile).st_mtime_ns)
+		except OSError:
+			return None
+
+		if version in (self._worker_versions.get(worker_type), self._worker_broken_versions.get(worker_type)):
+			return self._worker_map.get(worker_type)
+
+		spec = importlib.util.spec_from_file_location(worker_type, str(pythonfile))
+		worker_module = importlib.util.module_from_spec(spec)
+		try:
+			spec.loader.exec_module(worker_module)
+		except Exception as e:
+			# e.g. a file that is being edited - keep using the version that
+			# was loaded before (if any), and don't retry until the file is
+			# modified again
+			self._log.error("Could not load worker from %s (%s: %s), using previously loaded version if available" % (
+				pythonfile, e.__class__.__name__, str(e)))
+			self._worker_broken_versions[worker_type] = version
+			return self._worker_map.get(worker_type)
+
+		sys.modules[worker_type] = worker_module
+		self._worker_broken_versions.pop(worker_type, None)
+
+		self._worker_versions[worker_type] = version
+		self._worker_map.pop(worker_type, None)
+
+		# sorted, so the same class is picked as before when a file has more
+		# than one that qualifies
+		for name, component in sorted(vars(worker_module).items()):
+			if name[0:2] != "__" \
+					and inspect.isclass(component) \
+					and issubclass(component, BasicWorker) \
+					and not inspect.isabstract(component):
+				self._worker_map[worker_type] = component
+				return component
 
 		return None
 
@@ -283,6 +415,7 @@ class WorkerManager(threading.Thread):
 		"""
 		while self.looping:
 			self.delegate()
+			self.wait_for_jobs()
 
 		self._log.info("Telling all workers to stop doing whatever they're doing...")
 		for pythonfile in self._worker_pool:
@@ -302,6 +435,7 @@ class WorkerManager(threading.Thread):
 		time.sleep(3)
 
 		# abort
+		self._listener.close()
 		self._log.info("Bye!")
 
 	def abort(self, signal=None, stack=None):
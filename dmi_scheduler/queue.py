@@ -6,6 +6,7 @@ import json
 
 from uuid import uuid4
 from dmi_scheduler.job import Job
+import psycopg2.extensions
 import psycopg2
 
 
@@ -17,6 +18,9 @@ class JobQueue:
 	can use to do its job. The job queue is shared between workers so that nothing
 	is done twice.
 	"""
+	# channel on which newly added jobs are announced
+	NOTIFY_CHANNEL = "new_job"
+
 	_db = None
 	_log = None
 
@@ -30,33 +34,43 @@ class JobQueue:
 
 	def get_job(self, pythonfile, timestamp=-1):
 		"""
-		Get job of a specific type
+		Claim a job of a specific type
 
-		Returns a job's data. The `details` column is parsed JSON, and can thus contain all
-		kinds of data.
+		The earliest queued job that may be claimed is claimed and returned.
+		This happens in a single query, so the same job cannot be claimed by
+		anyone else in the meantime; jobs that are being claimed concurrently
+		are skipped in favour of the next one in line.
 
 		:param string pythonfile:  Job type
 		:param int timestamp:  Find jobs that may be claimed after this timestamp. If set to
 							   a negative value (default), any job with a "claim after" time
 							   earlier than the current time is selected.
-		:return dict: Job data, or `None` if no job was found
+		:return Job: Claimed job, or `None` if no job was found
 		"""
+		now = int(time.time())
 		if timestamp < 0:
-			timestamp = int(time.time())
+			timestamp = now
 
+		# as in Job.claim(), the claim time of recurring jobs is a multiple of
+		# their interval, to prevent the interval from drifting
 		job = self._db.fetchone((
-			"SELECT * FROM jobs"
-			"        WHERE pythonfile = %s"
-			"          AND timestamp_claimed = 0"
-			"          AND timestamp_after < %s"
-			"          AND (interval = 0 OR timestamp_lastclaimed + interval < %s)"
-			"    ORDER BY timestamp ASC"
-			"       LIMIT 1;"),
-			(pythonfile, timestamp, timestamp))
+			"UPDATE jobs SET timestamp_claimed = claim.time, timestamp_lastclaimed = claim.time"
+			"  FROM (SELECT id, CASE WHEN interval = 0 THEN %s ELSE %s / interval * interval END AS time"
+			"          FROM jobs"
+			"         WHERE pythonfile = %s"
+			"           AND timestamp_claimed = 0"
+			"           AND timestamp_after < %s"
+			"           AND next_claim_at < %s"
+			"      ORDER BY timestamp ASC"
+			"         LIMIT 1"
+			"           FOR UPDATE SKIP LOCKED) AS claim"
+			" WHERE jobs.id = claim.id"
+			" RETURNING jobs.*"),
+			(now, now, pythonfile, timestamp, timestamp), prepare=True)
 
 		return Job.get_by_data(job, database=self._db) if job else None
 
-	def get_all_jobs(self, pythonfile="*", remote_id=False, restrict_claimable=True):
+	def get_all_jobs(self, pythonfile="*", remote_id=False, restrict_claimable=True, skip_pythonfiles=None, stream=False):
 		"""
 		Get all unclaimed (and claimable) jobs
 
@@ -64,6 +78,10 @@ class JobQueue:
 		:param string remote_id:  Remote ID, takes precedence over `pythonfile`
 		:param bool restrict_claimable:  Only return jobs that may be claimed
 		according to their parameters
+		:param list skip_pythonfiles:  Types of job to leave out
+		:param bool stream:  Return a generator that reads jobs from the
+		database while iterating, instead of a list. Useful for large
+		amounts of jobs.
 		:return list:
 		"""
 		replacements = []
@@ -78,10 +96,14 @@ class JobQueue:
 
 		query = "SELECT * FROM jobs %s" % filter
 
+		if skip_pythonfiles:
+			query += "        AND pythonfile != ALL(%s)"
+			replacements.append(list(skip_pythonfiles))
+
 		if restrict_claimable:
 			query += ("        AND timestamp_claimed = 0"
 					  "              AND timestamp_after < %s"
-					  "              AND (interval = 0 OR timestamp_lastclaimed + interval < %s)")
+					  "              AND next_claim_at < %s")
 
 			now = int(time.time())
 			replacements.append(now)
@@ -89,8 +111,11 @@ class JobQueue:
 
 		query += "         ORDER BY timestamp ASC"
 
+		if stream:
+			return Job.get_by_rows(self._db.iterall(query, replacements), self._db)
+
 		try:
-			jobs = self._db.fetchall(query, replacements)
+			jobs = self._db.fetchall(query, replacements, prepare=True)
 		except psycopg2.ProgrammingError:
 			# there seems to be a bug with psycopg2 where it sometimes raises
 			# this for empty query results even though it shouldn't. this
@@ -99,15 +124,49 @@ class JobQueue:
 			# https://github.com/psycopg/psycopg2/issues/346
 			jobs = []
 
-		return [Job.get_by_data(job, self._db) for job in jobs if job]
+		return list(Job.get_by_rows(jobs, self._db))
 
-	def get_job_count(self, pythonfile="*"):
+	def has_jobs(self):
+		"""
+		Are there any jobs that may be claimed?
+
+		This gives the same answer as checking whether `get_all_jobs()`
+		returns anything, but only a single boolean is sent back by the
+		database instead of every job.
+
+		:return bool:
+		"""
+		now = int(time.time())
+		row = self._db.fetchone((
+			"SELECT EXISTS(SELECT 1 FROM jobs"
+			"               WHERE pythonfile != ''"
+			"                 AND timestamp_claimed = 0"
+			"                 AND timestamp_after < %s"
+			"                 AND next_claim_at < %s)"),
+			(now, now), cursor_factory=psycopg2.extensions.cursor, prepare=True)
+
+		return bool(row[0])
+
+	def get_job_count(self, pythonfile="*", exact=True):
 		"""
 		Get total number of jobs
 
 		:param pythonfile:  Type of jobs to count. Default (`*`) counts all jobs.
+		:param bool exact:  If `False`, and all jobs are counted, return the
+		estimate PostgreSQL keeps for the table's size instead. This does not
+		need to scan the table and is thus much faster for large queues, but
+		may be off by some margin.
 		:return int:  Number of jobs
 		"""
+		if not exact and pythonfile == "*":
+			estimate = self._db.fetchone("SELECT reltuples::bigint AS count FROM pg_class WHERE oid = 'jobs'::regclass")
+			# a table that has never been analysed has no estimate, which
+			# depending on the PostgreSQL version is -1 or 0. an actual
+			# estimate of 0 is indistinguishable from the latter, but then the
+			# table is (nearly) empty and counting is cheap anyway
+			if estimate and estimate["count"] > 0:
+				return int(estimate["count"])
+
 		if pythonfile == "*":
 			count = self._db.fetchone("SELECT COUNT(*) FROM jobs;", ())
 		else:
@@ -135,13 +194,82 @@ class JobQueue:
 		             with those parameters could be queued, and the old one is
 		             just as valid).
 		"""
+		data = self._job_data(pythonfile, details, remote_id, claim_after, interval)
+
+		# the notification is sent when the insert is committed
+		with self._db.transaction() as tx:
+			tx.insert("jobs", data, safe=True, constraints=("pythonfile", "remote_id"))
+			tx.execute("NOTIFY %s" % self.NOTIFY_CHANNEL)
+
+		return Job.get_by_data(data, database=self._db)
+
+	def add_jobs(self, jobs):
+		"""
+		Add a number of new jobs to the queue at once
+
+		This has the same effect as calling `add_job()` for each job, but the
+		jobs are inserted with as few queries as possible, and committed
+		together.
+
+		:param jobs:  Iterable of dictionaries, each with the arguments that
+		would be passed to `add_job()`. Only `pythonfile` is required.
+
+		:return list: A list of `Job`s, as `add_job()` would return them
+		"""
+		now = int(time.time())
+		data = [self._job_data(timestamp=now, **job) for job in jobs]
+		if not data:
+			return []
+
+		with self._db.transaction() as tx:
+			tx.insert("jobs", data, safe=True, constraints=("pythonfile", "remote_id"))
+			tx.execute("NOTIFY %s" % self.NOTIFY_CHANNEL)
+
+		return [Job.get_by_data(job, database=self._db) for job in data]
+
+	def bulk_cancel(self, jobs, status):
+		"""
+		Add a status to a number of jobs and finish them
+
+		This has the same effect as calling `add_status()` and `finish()` for
+		each job, but takes at most two queries and one commit however many
+		jobs there are.
+
+		:param list jobs:  Jobs to cancel
+		:param str status:  Status to add
+		"""
+		deleted = [job.data["id"] for job in jobs if job.data["interval"] == 0]
+		recurring = [(job.data["id"], json.dumps(job.get_status() + [status])) for job in jobs if
+					 job.data["interval"] != 0]
+
+		with self._db.transaction() as tx:
+			if deleted:
+				tx.execute("DELETE FROM jobs WHERE id = ANY(%s)", (deleted,))
+
+			if recurring:
+				tx.execute_many(
+					"UPDATE jobs SET status = data.status, timestamp_claimed = 0, attempts = 0"
+					"  FROM (VALUES %s) AS data (id, status)"
+					" WHERE jobs.id = data.id", recurring)
+
+		for job in jobs:
+			job.is_finished = True
+
+	def _job_data(self, pythonfile, details=None, remote_id=None, claim_after=0, interval=0, timestamp=None):
+		"""
+		Get the database record for a new job
+
+		:param timestamp:  Time at which the job was queued, the current time
+		if left empty. See `add_job()` for the other parameters.
+		:return dict:
+		"""
 		if not remote_id:
 			remote_id = str(uuid4())
 
-		data = data = {
+		return {
 			"pythonfile": str(pythonfile),
 			"details": json.dumps(details),
-			"timestamp": int(time.time()),
+			"timestamp": int(time.time()) if timestamp is None else timestamp,
 			"timestamp_claimed": 0,
 			"timestamp_lastclaimed": 0,
 			"remote_id": remote_id,
@@ -150,10 +278,6 @@ class JobQueue:
 			"attempts": 0
 		}
 
-		self._db.insert("jobs", data, safe=True, constraints=("pythonfile", "remote_id"))
-
-		return Job.get_by_data(data, database=self._db)
-
 	def release_all(self):
 		"""
 		Release all jobs
@@ -175,8 +299,14 @@ class JobQueue:
 		if job.data["timestamp_claimed"] > 0:
 			return 0
 
-		all_queued = self.get_all_jobs(pythonfile=job.data["pythonfile"])
-		our_timestamp = job.data["timestamp"]
-		return len(
-			[queued_job for queued_job in all_queued if
-			 queued_job.data["timestamp"] < our_timestamp or queued_job.data["timestamp_claimed"] > 0])
+		now = int(time.time())
+		count = self._db.fetchone((
+			"SELECT COUNT(*) FROM jobs"
+			"        WHERE pythonfile = %s"
+			"          AND timestamp < %s"
+			"          AND timestamp_claimed = 0"
+			"          AND timestamp_after < %s"
+			"          AND next_claim_at < %s"),
+			(job.data["pythonfile"], job.data["timestamp"], now, now), prepare=True)
+
+		return int(count["count"])
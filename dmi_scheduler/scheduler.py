@@ -29,7 +29,7 @@ class Scheduler:
 
 		:return bool:
 		"""
-		return len(self._manager.queue.get_all_jobs()) > 0
+		return self._manager.queue.has_jobs()
 
 	def end(self):
 		"""
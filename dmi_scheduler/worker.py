@@ -53,6 +53,7 @@ class BasicWorker(threading.Thread, metaclass=abc.ABCMeta):
 
 		This simply calls the work method
 		"""
+		status = None
 		try:
 			self.work()
 		except WorkerInterruptedException:
@@ -71,9 +72,22 @@ class BasicWorker(threading.Thread, metaclass=abc.ABCMeta):
 			location = "->".join(frames)
 			self.log.error("Worker %s raised exception %s and will abort: %s at %s" % (
 			self.type, e.__class__.__name__, str(e), location))
-			self.job.add_status("Crash during execution")
-
-		self.after_work()
+			status = "Crash during execution"
+
+		# commit the final status and finishing of the job in one go. the
+		# default after_work() only finishes the job, so then the queries can
+		# be sent in one go too; overridden versions may rely on the results
+		# of their queries, so those are run as usual
+		if type(self).after_work is BasicWorker.after_work:
+			bookkeeping = self.manager._db.pipeline()
+		else:
+			bookkeeping = self.manager._db.transaction()
+
+		with bookkeeping:
+			if status:
+				self.job.add_status(status)
+
+			self.after_work()
 
 	def after_work(self):
 		self.job.finish()